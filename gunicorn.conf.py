@@ -0,0 +1,13 @@
+import os
+
+# Exactly one worker: the price scheduler, batch writer, update_id dedup and
+# caches all live in process memory, so extra workers would record duplicate
+# prices and process redelivered updates twice. WEB_CONCURRENCY is ignored on
+# purpose; scale with GUNICORN_THREADS, which lets concurrent Telegram
+# webhook deliveries overlap their Sheets and Telegram I/O.
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+keepalive = 75
+timeout = 30
@@ -1,29 +1,54 @@
 import os
+import sys
 import json
-import traceback
+import re
+import orjson
+import logging
 import datetime
+import time
+import threading
+import queue
+import random
 from flask import Flask, request
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.auth.transport.requests import AuthorizedSession
 import requests
-from googleapiclient.errors import HttpError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import quote
 from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from itertools import zip_longest
 
 app = Flask(__name__)
 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+log = logging.getLogger("mkstrades")
+
 # Environment variables
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID", "")
 SERVICE_ACCOUNT_FILE = os.getenv("SERVICE_ACCOUNT_FILE", "service_account.json")
 COINGECKO_API_KEY = os.getenv("COINGECKO_API_KEY", "")
+COINGECKO_RPS = float(os.getenv("COINGECKO_RPS", "0.5"))
+PRICE_CHANGE_EPSILON = float(os.getenv("PRICE_CHANGE_EPSILON", "0"))
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID", "")
 
+REQUIRED_ENV_VARS = ["BOT_TOKEN", "SPREADSHEET_ID", "COINGECKO_API_KEY", "ADMIN_CHAT_ID"]
+missing_env_vars = [name for name in REQUIRED_ENV_VARS if not os.getenv(name)]
+if missing_env_vars:
+    raise ValueError(f"Missing required environment variables: {', '.join(missing_env_vars)}")
+
 # Initialize scheduler
 scheduler = BackgroundScheduler(daemon=True)
 scheduler.start()
 atexit.register(lambda: scheduler.shutdown())
 
+# Background executor: webhook updates are processed off the request thread
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+atexit.register(lambda: EXECUTOR.shutdown(wait=False))
+
 # Load Google Sheets API credentials
 if not os.path.exists(SERVICE_ACCOUNT_FILE):
     raise ValueError(f"Service account file not found: {SERVICE_ACCOUNT_FILE}")
@@ -32,174 +57,458 @@ try:
         SERVICE_ACCOUNT_FILE,
         scopes=["https://www.googleapis.com/auth/spreadsheets"]
     )
-    sheets_service = build("sheets", "v4", credentials=creds)
 except Exception as e:
     raise ValueError(f"Failed to load service account credentials: {e}")
 
+# All Sheets calls go through one pooled keep-alive session. requests sessions
+# can be shared across the webhook, writer and scheduler threads, unlike the
+# httplib2 transport used by googleapiclient.
+SHEETS_API_URL = f"https://sheets.googleapis.com/v4/spreadsheets/{SPREADSHEET_ID}"
+
+class JitteredRetry(Retry):
+    """Truncated exponential backoff with jitter that only resends writes on 429"""
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        # Writes aren't idempotent, but a 429 means the request was rejected
+        # before being applied, so it is safe to send again
+        if status_code == 429 and self.total:
+            return True
+        return super().is_retry(method, status_code, has_retry_after)
+
+    def get_backoff_time(self):
+        # Spread retries by +/-25% so the worker threads don't retry in lockstep
+        return super().get_backoff_time() * random.uniform(0.75, 1.25)
+
+sheets_session = AuthorizedSession(creds)
+sheets_session.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=JitteredRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        # Hand the final error response to raise_for_status for a useful message
+        raise_on_status=False
+    )
+))
+# Google only compresses responses when the User-Agent mentions gzip
+sheets_session.headers.update({
+    "Accept-Encoding": "gzip",
+    "User-Agent": "mkstrades/1.0 (gzip)"
+})
+
+def sheets_request(method, path, params=None, body=None):
+    """Call the Sheets REST API over the pooled session and return the JSON reply"""
+    response = sheets_session.request(
+        method,
+        f"{SHEETS_API_URL}{path}",
+        params=params,
+        data=orjson.dumps(body) if body is not None else None,
+        headers={"Content-Type": "application/json"} if body is not None else None,
+        timeout=30
+    )
+    response.raise_for_status()
+    return orjson.loads(response.content)
+
+def values_path(range_name):
+    """Return the REST path for a values resource in A1 notation"""
+    return f"/values/{quote(range_name, safe='!:')}"
+
+def batch_read(ranges):
+    """Read several A1 ranges in one values.batchGet and return their rows in order"""
+    value_ranges = sheets_request(
+        "GET",
+        "/values:batchGet",
+        params={"ranges": ranges, "valueRenderOption": "UNFORMATTED_VALUE"}
+    ).get('valueRanges', [])
+    return [value_range.get('values', []) for value_range in value_ranges]
+
+# Pooled keep-alive session for Telegram Bot API calls
+TELEGRAM_API_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+TELEGRAM_SEND_MESSAGE_URL = f"{TELEGRAM_API_URL}/sendMessage"
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+TG_SESSION = requests.Session()
+TG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Bot API calls are POSTs; a 5xx or read timeout may already have delivered
+    # the message, so only 429s and connect errors are retried for them
+    max_retries=JitteredRetry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504]
+    )
+))
+# Every Bot API call posts an orjson-encoded body
+TG_SESSION.headers.update({"Content-Type": "application/json"})
+
+# ---------------------------
+# Sheet Read Cache
+# ---------------------------
+
+SHEET_CACHE_TTL = 30  # seconds
+SHEET_CACHE_MAXSIZE = 64
+_sheet_cache = {}
+_trades_cache = {}
+# Reads in progress, so concurrent misses on one key share a single request
+_sheet_cache_inflight = {}
+_sheet_cache_lock = threading.Lock()
+
+# Trade sheet columns used by the aggregates: coin, quantity, total, type
+TRADE_COLUMNS = ("C", "E", "G", "H")
+
+def get_columns_cached(sheet_name, columns):
+    """Return unformatted column values for a sheet, reusing reads younger than SHEET_CACHE_TTL"""
+    cache_key = f"{sheet_name}!{','.join(columns)}"
+    now = time.monotonic()
+    with _sheet_cache_lock:
+        entry = _sheet_cache.get(cache_key)
+        if entry and entry[1] > now:
+            return entry[0]
+        future = _sheet_cache_inflight.get(cache_key)
+        is_leader = future is None
+        if is_leader:
+            future = _sheet_cache_inflight[cache_key] = Future()
+    if not is_leader:
+        return future.result()
+
+    # Quote the title, doubling any ', so names like jean-luc or o'neil are valid A1
+    quoted_title = "'{}'".format(sheet_name.replace("'", "''"))
+    try:
+        # Fetch only the needed columns, column-major, in a single batchGet
+        value_ranges = sheets_request(
+            "GET",
+            "/values:batchGet",
+            params={
+                "ranges": [f"{quoted_title}!{column}2:{column}" for column in columns],
+                "majorDimension": "COLUMNS",
+                "valueRenderOption": "UNFORMATTED_VALUE"
+            }
+        ).get('valueRanges', [])
+        values = [(value_range.get('values') or [[]])[0] for value_range in value_ranges]
+    except Exception as e:
+        with _sheet_cache_lock:
+            if _sheet_cache_inflight.get(cache_key) is future:
+                del _sheet_cache_inflight[cache_key]
+        future.set_exception(e)
+        raise
+
+    with _sheet_cache_lock:
+        # A write that invalidated this key mid-read unregistered the read,
+        # and its result may predate that write, so it isn't cached
+        if _sheet_cache_inflight.get(cache_key) is future:
+            del _sheet_cache_inflight[cache_key]
+            if cache_key not in _sheet_cache and len(_sheet_cache) >= SHEET_CACHE_MAXSIZE:
+                _sheet_cache.pop(next(iter(_sheet_cache)))
+            # Keep the time the response arrived: only a write queued after
+            # that moment is certain not to be included in these values
+            _sheet_cache[cache_key] = (values, now + SHEET_CACHE_TTL, time.monotonic())
+    future.set_result(values)
+    return values
+
+# Signed direction of each order type; unknown types don't move holdings
+ORDER_SIGNS = {"BUY": 1, "SELL": -1}
+
+def summarize_trade_columns(columns):
+    """Fold TRADE_COLUMNS values into {coin: [net_quantity, buy_quantity, buy_cost]} in one pass"""
+    totals = {}
+    # Sheets hold only a handful of distinct coin and type spellings, so each
+    # raw value is normalized once instead of allocating new strings per row
+    signs = dict(ORDER_SIGNS)
+    coin_keys = {}
+    for coin, quantity, total, order_type in zip_longest(*columns, fillvalue=""):
+        if order_type == "":
+            continue
+        # UNFORMATTED_VALUE returns number cells as numbers; only text typed
+        # into the sheet by hand still needs parsing
+        if not isinstance(quantity, (int, float)):
+            try:
+                quantity = float(quantity)
+            except (ValueError, TypeError):
+                continue
+        sign = signs.get(order_type)
+        if sign is None:
+            sign = signs[order_type] = ORDER_SIGNS.get(str(order_type).strip().upper(), 0)
+        coin_key = coin_keys.get(coin)
+        if coin_key is None:
+            # Intern coin symbols so per-coin lookups compare by identity first
+            coin_key = coin_keys[coin] = sys.intern(str(coin).strip().upper())
+        coin_totals = totals.setdefault(coin_key, [0.0, 0.0, 0.0])
+        coin_totals[0] += sign * quantity
+        if sign == 1:
+            if not isinstance(total, (int, float)):
+                try:
+                    total = float(total)
+                except (ValueError, TypeError):
+                    continue
+            coin_totals[2] += total
+            coin_totals[1] += quantity
+    return totals
+
+def get_sheet_totals(sheet_name):
+    """Return per-coin totals for a sheet, rebuilt only when the cached snapshot changes"""
+    values = get_columns_cached(sheet_name, TRADE_COLUMNS)
+    with _sheet_cache_lock:
+        entry = _trades_cache.get(sheet_name)
+    if entry and entry[0] is values:
+        return entry[1]
+
+    totals = summarize_trade_columns(values)
+    with _sheet_cache_lock:
+        _trades_cache[sheet_name] = (values, totals)
+    return totals
+
+def get_trade_totals(sheet_name, coin):
+    """Return [net_quantity, buy_quantity, buy_cost] for a coin within a sheet"""
+    return get_sheet_totals(sheet_name).get(coin, [0.0, 0.0, 0.0])
+
+def apply_trade_to_cache(sheet_names, written_after, coin, sign, quantity, total):
+    """Fold a just-written trade into cached totals instead of re-reading the sheets"""
+    # Only snapshots whose response arrived before the write was queued are
+    # safe to update; a read still in flight or answered later may already
+    # include the row, so those sheets are dropped.
+    column_key_suffix = f"!{','.join(TRADE_COLUMNS)}"
+    stale = []
+    with _sheet_cache_lock:
+        prefixes = tuple(f"{name}!" for name in sheet_names)
+        for cache_key in [k for k in _sheet_cache_inflight if k.startswith(prefixes)]:
+            del _sheet_cache_inflight[cache_key]
+        for sheet_name in sheet_names:
+            columns_entry = _sheet_cache.get(sheet_name + column_key_suffix)
+            totals_entry = _trades_cache.get(sheet_name)
+            if (
+                columns_entry is None
+                or totals_entry is None
+                or totals_entry[0] is not columns_entry[0]
+                or columns_entry[2] >= written_after
+            ):
+                stale.append(sheet_name)
+                continue
+
+            net_quantity, buy_quantity, buy_cost = totals_entry[1].get(coin, [0.0, 0.0, 0.0])
+            net_quantity += sign * quantity
+            if sign == 1:
+                buy_quantity += quantity
+                buy_cost += total
+            # Replace rather than mutate so concurrent readers see consistent totals
+            totals = {**totals_entry[1], coin: [net_quantity, buy_quantity, buy_cost]}
+            _trades_cache[sheet_name] = (totals_entry[0], totals)
+    if stale:
+        invalidate_sheet_cache(*stale)
+
+def invalidate_sheet_cache(*sheet_names):
+    """Drop cached reads belonging to the given sheets after a write"""
+    prefixes = tuple(f"{name}!" for name in sheet_names)
+    with _sheet_cache_lock:
+        for cache_key in [k for k in _sheet_cache if k.startswith(prefixes)]:
+            del _sheet_cache[cache_key]
+        # Later callers must not join reads that started before the write
+        for cache_key in [k for k in _sheet_cache_inflight if k.startswith(prefixes)]:
+            del _sheet_cache_inflight[cache_key]
+        for sheet_name in sheet_names:
+            _trades_cache.pop(sheet_name, None)
+
 # ---------------------------
 # Price Tracking Enhancements
 # ---------------------------
 
 COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
 
+# Pooled keep-alive session for CoinGecko so each price tick reuses one TLS connection
+CG_SESSION = requests.Session()
+CG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=2,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET"])
+    )
+))
+CG_SESSION.headers.update({
+    "Accept-Encoding": "gzip",
+    "x-cg-pro-api-key": COINGECKO_API_KEY
+})
+
+# Client-side throttle: a one-token bucket refilled at COINGECKO_RPS, so price
+# batches queue up instead of tripping CoinGecko's rate limit (0 disables it)
+_cg_next_slot = 0.0
+_cg_rate_lock = threading.Lock()
+
+def wait_for_coingecko_slot():
+    """Block until the next CoinGecko request fits under COINGECKO_RPS"""
+    global _cg_next_slot
+    if COINGECKO_RPS <= 0:
+        return
+    with _cg_rate_lock:
+        now = time.monotonic()
+        wait = _cg_next_slot - now
+        _cg_next_slot = max(now, _cg_next_slot) + 1 / COINGECKO_RPS
+    if wait > 0:
+        time.sleep(wait)
+
+DAILY_PRICES_HEADERS = ["Timestamp", "CoinSymbol", "CoinGeckoID", "PriceUSD"]
+COIN_MAPPINGS_HEADERS = ["CoinSymbol", "CoinGeckoID"]
+MASTER_COINS_RANGE = "Master!C2:C"
+COIN_MAPPINGS_RANGE = "CoinMappings!A2:B"
+
 def setup_daily_prices_sheet():
-    """Create DailyPrices sheet with headers if it doesn't exist"""
-    sheet_name = "DailyPrices"
-    create_sheet_if_not_exists(sheet_name)
-    
-    headers_range = f"{sheet_name}!A1:D1"
-    result = sheets_service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=headers_range
-    ).execute()
-    values = result.get('values', [])
-    
-    if not values:
-        headers = ["Timestamp", "CoinSymbol", "CoinGeckoID", "PriceUSD"]
-        sheets_service.spreadsheets().values().update(
-            spreadsheetId=SPREADSHEET_ID,
-            range=headers_range,
-            valueInputOption="RAW",
-            body={"values": [headers]}
-        ).execute()
+    """Create the DailyPrices and CoinMappings sheets with headers if they don't exist"""
+    # Headers are written in the same batchUpdate that adds a sheet, so
+    # existing sheets cost only a lookup in the cached sheet map
+    ensure_trade_sheets(["DailyPrices"], headers=DAILY_PRICES_HEADERS)
+    ensure_trade_sheets(["CoinMappings"], headers=COIN_MAPPINGS_HEADERS)
 
 def check_coin_mapping(coin_symbol):
-    """Check if a coin symbol exists in CoinMappings sheet"""
-    mappings = get_coin_mappings()
-    if not mappings.get(coin_symbol):
-        send_telegram_message(
-            ADMIN_CHAT_ID,
-            f"⚠️ New coin detected! Please add mapping for {coin_symbol} to CoinMappings sheet"
-        )
+    """Check if a coin symbol exists in CoinMappings sheet, alerting the admin if not"""
+    try:
+        mappings = get_coin_mappings()
+        if not mappings.get(coin_symbol):
+            send_telegram_message(
+                ADMIN_CHAT_ID,
+                f"⚠️ New coin detected! Please add mapping for {coin_symbol} to CoinMappings sheet"
+            )
+            # Re-read on the next check so the admin's new mapping shows up at once
+            invalidate_coin_mappings()
+            return False
+        return True
+    except Exception as e:
+        log.exception("Error in check_coin_mapping")
         return False
-    return True
+
+def parse_coin_mappings(rows):
+    """Build {symbol: CoinGecko ID} from CoinMappings rows"""
+    return {str(row[0]).upper(): str(row[1]).lower() for row in rows if len(row) >= 2 and row[1]}
+
+# Mappings change at human pace, so parsed CoinMappings are reused for
+# COIN_MAPPINGS_TTL seconds as a (mappings, expiry) pair
+COIN_MAPPINGS_TTL = 600  # seconds
+_coin_mappings = (None, 0.0)
+
+def cache_coin_mappings(rows):
+    """Parse CoinMappings rows and keep the result for COIN_MAPPINGS_TTL seconds"""
+    global _coin_mappings
+    mappings = parse_coin_mappings(rows)
+    _coin_mappings = (mappings, time.monotonic() + COIN_MAPPINGS_TTL)
+    return mappings
+
+def cached_coin_mappings():
+    """Return the cached mappings, or None once they are older than COIN_MAPPINGS_TTL"""
+    mappings, expiry = _coin_mappings
+    return mappings if time.monotonic() < expiry else None
+
+def invalidate_coin_mappings():
+    """Force the next get_coin_mappings call to re-read the sheet"""
+    global _coin_mappings
+    _coin_mappings = (None, 0.0)
 
 def get_coin_mappings():
     """Retrieve symbol to CoinGecko ID mappings from CoinMappings sheet"""
-    sheet_name = "CoinMappings"
-    create_sheet_if_not_exists(sheet_name)
-    
-    range_name = f"{sheet_name}!A2:B"
-    result = sheets_service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range=range_name
-    ).execute()
-    values = result.get('values', [])
-    
-    return {row[0].upper(): row[1].lower() for row in values if len(row) >= 2}
-
-def get_unique_coins():
-    """Extract unique coin symbols from all relevant sheets"""
-    coins = set()
-    
-    # Check Master sheet
-    master_coins = sheets_service.spreadsheets().values().get(
-        spreadsheetId=SPREADSHEET_ID,
-        range="Master!C2:C"
-    ).execute().get('values', [])
-    coins.update(row[0].upper() for row in master_coins if row)
-    
-    # Check existing coin sheets
-    spreadsheet = sheets_service.spreadsheets().get(
-        spreadsheetId=SPREADSHEET_ID
-    ).execute()
-    sheets = spreadsheet.get('sheets', [])
-    coins.update(s['properties']['title'] for s in sheets if s['properties']['title'] != "Master")
-    
-    return list(coins)
+    mappings = cached_coin_mappings()
+    if mappings is None:
+        # /add and the startup priming job can run before the first price
+        # tick has created the tab; a fresh tab simply reads as no mappings
+        ensure_trade_sheets(["CoinMappings"], headers=COIN_MAPPINGS_HEADERS)
+        mappings = cache_coin_mappings(batch_read([COIN_MAPPINGS_RANGE])[0])
+    return mappings
+
+def get_unique_coins(master_rows, mappings):
+    """Return the mapped coin symbols found in Master rows or as sheet titles"""
+    coins = {str(row[0]).upper() for row in master_rows if row}
+    coins.update(get_sheet_ids())
+    # Person and system tabs never have a mapping, so they drop out here
+    return coins & mappings.keys()
 
 def fetch_coingecko_prices(coin_ids):
     """Fetch current USD prices from CoinGecko API"""
-    headers = {"x-cg-pro-api-key": COINGECKO_API_KEY}
     params = {'ids': ','.join(coin_ids), 'vs_currencies': 'usd'}
     
     try:
-        response = requests.get(
+        wait_for_coingecko_slot()
+        response = CG_SESSION.get(
             f"{COINGECKO_API_URL}/simple/price",
-            headers=headers,
             params=params,
             timeout=10
         )
         response.raise_for_status()
-        return response.json()
+        return orjson.loads(response.content)
     except Exception as e:
-        print(f"Price fetch error: {str(e)}")
+        log.warning("Price fetch error: %s", e)
         return None
 
+# Opt-in thinning of DailyPrices: with PRICE_CHANGE_EPSILON > 0 a price is
+# only appended when it moved more than that fraction since last recorded, or
+# at least every PRICE_HEARTBEAT seconds. The default 0 records every tick.
+PRICE_HEARTBEAT = 3600  # seconds
+# Ticks drift by milliseconds, so allow a minute of slack; otherwise the
+# heartbeat can slip a whole tick and leave 65-minute gaps
+PRICE_HEARTBEAT_SLACK = 60  # seconds
+_last_recorded_prices = {}  # symbol -> (price, monotonic time recorded)
+
+def price_changed(symbol, price, now):
+    """Return True if a fetched price differs enough, or is old enough, to record"""
+    if PRICE_CHANGE_EPSILON <= 0:
+        return True
+    last = _last_recorded_prices.get(symbol)
+    if last is None or now - last[1] >= PRICE_HEARTBEAT - PRICE_HEARTBEAT_SLACK:
+        return True
+    return abs(price - last[0]) > PRICE_CHANGE_EPSILON * abs(last[0])
+
 def record_prices():
     """Main function to record prices to DailyPrices sheet"""
     try:
         setup_daily_prices_sheet()
-        mappings = get_coin_mappings()
-        coins = get_unique_coins()
-        
-        valid_coins = []
-        for symbol in coins:
-            if cg_id := mappings.get(symbol):
-                valid_coins.append((symbol, cg_id))
-        
+        # Master coins, plus the mappings when their cache has expired, come
+        # back from a single batchGet
+        mappings = cached_coin_mappings()
+        if mappings is None:
+            master_rows, mapping_rows = batch_read([MASTER_COINS_RANGE, COIN_MAPPINGS_RANGE])
+            mappings = cache_coin_mappings(mapping_rows)
+        else:
+            master_rows = batch_read([MASTER_COINS_RANGE])[0]
+        valid_coins = [(symbol, mappings[symbol]) for symbol in get_unique_coins(master_rows, mappings)]
         if not valid_coins:
             return
 
-        # Batch process to handle API limits
+        # Batch process to handle API limits, collecting every batch's rows
+        # so the sheet gets a single append per tick
         batch_size = 250  # CoinGecko's max per request
+        all_rows = []
+        # One timestamp per tick, so every row of a snapshot groups together
+        timestamp = datetime.datetime.utcnow().isoformat()
         for i in range(0, len(valid_coins), batch_size):
             batch = valid_coins[i:i+batch_size]
             coin_ids = [cg_id for _, cg_id in batch]
             
             if prices := fetch_coingecko_prices(coin_ids):
-                timestamp = datetime.datetime.utcnow().isoformat()
-                rows = [
+                all_rows.extend(
                     [timestamp, symbol, cg_id, prices[cg_id]['usd']]
                     for symbol, cg_id in batch
                     if prices.get(cg_id, {}).get('usd')
-                ]
-                
-                if rows:
-                    sheets_service.spreadsheets().values().append(
-                        spreadsheetId=SPREADSHEET_ID,
-                        range="DailyPrices!A2",
-                        valueInputOption="USER_ENTERED",
-                        body={"values": rows}
-                    ).execute()
+                )
+
+        now = time.monotonic()
+        all_rows = [row for row in all_rows if price_changed(row[1], row[3], now)]
+        if all_rows:
+            sheets_request(
+                "POST",
+                f"{values_path('DailyPrices!A2')}:append",
+                params={
+                    "valueInputOption": "USER_ENTERED",
+                    "insertDataOption": "INSERT_ROWS",
+                    "includeValuesInResponse": "false"
+                },
+                body={"values": all_rows}
+            )
+            _last_recorded_prices.update((row[1], (row[3], now)) for row in all_rows)
 
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in record_prices")
         send_telegram_message(ADMIN_CHAT_ID, f"⚠️ Price update failed: {str(e)}")
 
-# Schedule price updates every 5 minutes
-scheduler.add_job(
-    record_prices,
-    'interval',
-    minutes=5,
-    next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=10)
-)
-
-# ---------------------------
-# Modified Trade Processing
-# ---------------------------
-
-def process_add_command(command):
-    try:
-        parts = command.split(" ")
-        if len(parts) != 7:
-            return "Invalid format. Use: /add PERSON COIN PRICE QUANTITY EXCHANGE BUY/SELL"
-
-        coin = parts[2].upper()
-        if not check_coin_mapping(coin):
-            return f"✅ Trade recorded for {coin}, but missing CoinGecko mapping - admin notified"
-
-        # Rest of your existing process_add_command logic
-        # ... (keep all your existing trade processing code) ...
-
-        return f"✅ Trade recorded: {person} {order_type.lower()} {quantity} {coin} at ${price} on {exchange}."
-    except Exception as e:
-        traceback.print_exc()
-        return f"Error processing /add command: {e}"
-
 # ---------------------------
-# Existing Application Code 
-# (Keep all your original code below)
+# Telegram Bot
 # ---------------------------
 # Keyboard markup functions
 def get_main_keyboard():
@@ -227,12 +536,44 @@ def get_inline_keyboard():
 def index():
     return "Hello from Render + Python + Google Sheets!"
 
+# Telegram redelivers updates whose acknowledgement it didn't see in time;
+# remembering recent update_ids keeps a retried /add from being recorded twice
+SEEN_UPDATES_MAXSIZE = 1024
+_seen_update_ids = {}
+_seen_update_ids_lock = threading.Lock()
+
+def is_duplicate_update(update):
+    """Return True if this update_id was already accepted, recording it otherwise"""
+    update_id = update.get("update_id")
+    if update_id is None:
+        return False
+    with _seen_update_ids_lock:
+        if update_id in _seen_update_ids:
+            return True
+        if len(_seen_update_ids) >= SEEN_UPDATES_MAXSIZE:
+            _seen_update_ids.pop(next(iter(_seen_update_ids)))
+        _seen_update_ids[update_id] = None
+    return False
+
 @app.route(f"/{BOT_TOKEN}", methods=["POST"])
 def telegram_webhook():
     try:
-        update = request.get_json()
-        print(f"Received update: {update}")
+        update = orjson.loads(request.get_data(cache=False))
+        log.debug("Received update: %s", update)
+
+        # Acknowledge right away; Sheets and Telegram work runs in the background
+        if is_duplicate_update(update):
+            log.info("Skipping redelivered update %s", update.get("update_id"))
+        else:
+            EXECUTOR.submit(handle_update, update)
+        return "ok", 200
+    except Exception as e:
+        log.exception("Error in telegram_webhook")
+        return "error", 500
 
+def handle_update(update):
+    """Process a Telegram update on the background executor"""
+    try:
         # Handle inline keyboard callbacks
         if 'callback_query' in update:
             callback = update['callback_query']
@@ -240,9 +581,10 @@ def telegram_webhook():
             data = callback['data']
             
             # Send callback confirmation
-            requests.post(
-                f"https://api.telegram.org/bot{BOT_TOKEN}/answerCallbackQuery",
-                json={"callback_query_id": callback['id']}
+            TG_SESSION.post(
+                f"{TELEGRAM_API_URL}/answerCallbackQuery",
+                data=orjson.dumps({"callback_query_id": callback['id']}),
+                timeout=5
             )
             
             # Process callback data
@@ -252,193 +594,392 @@ def telegram_webhook():
                 send_telegram_message(chat_id, "🔢 Enter coin:\n/average COIN")
             elif data == "/holdings":
                 send_telegram_message(chat_id, "📈 Choose:\n/holdings COIN\nor\n/holdings PERSON COIN")
-            
-            return "ok", 200
+            return
 
         # Handle regular messages
         message = update.get("message")
         if not message:
-            return "ok", 200
+            return
 
         chat_id = message.get("chat", {}).get("id")
         text = message.get("text", "")
 
-        if text.startswith("/start"):
+        # Split once and route on the first token ("/cmd@botname" -> "/cmd")
+        parts = text.split()
+        command = parts[0].split("@", 1)[0] if parts else ""
+        if command == "/start":
             send_telegram_message(chat_id, "🤖 Welcome to Crypto Tracker Bot!", get_inline_keyboard())
             send_telegram_message(chat_id, "🛠️ Quick commands:", get_main_keyboard())
-        elif text.startswith("/help"):
-            help_text = """📚 Available Commands:
-/add - Record new trade
-/average - Check average price
-/holdings - View holdings
-
-📱 Use buttons or type commands directly!"""
-            send_telegram_message(chat_id, help_text)
-        elif text.startswith("/add"):
-            response = process_add_command(text)
-            send_telegram_message(chat_id, response)
-        elif text.startswith("/average"):
-            response = process_average_command(text)
-            send_telegram_message(chat_id, response)
-        elif text.startswith("/holdings"):
-            response = process_holdings_command(text)
-            send_telegram_message(chat_id, response)
         else:
-            send_telegram_message(chat_id, "❌ Unknown command. Use buttons or type /help")
-
-        return "ok", 200
+            handler = COMMAND_HANDLERS.get(command)
+            send_telegram_message(chat_id, handler(parts) if handler else UNKNOWN_COMMAND_TEXT)
     except Exception as e:
-        traceback.print_exc()
-        print(f"Error in telegram_webhook: {e}")
-        return "error", 500
+        log.exception("Error in handle_update")
 
 def send_telegram_message(chat_id, text, reply_markup=None):
-    """Send a message with optional keyboard"""
+    """Send a message with optional keyboard, split into Telegram-sized chunks"""
     try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        payload = {
-            "chat_id": chat_id,
-            "text": text,
-            "parse_mode": "Markdown"
-        }
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
+        # Slice lazily so only the chunk being sent is held in memory
+        for start in range(0, len(text) or 1, TELEGRAM_MAX_MESSAGE_LENGTH):
+            end = start + TELEGRAM_MAX_MESSAGE_LENGTH
+            payload = {
+                "chat_id": chat_id,
+                "text": text[start:end],
+                "parse_mode": "Markdown"
+            }
+            # Attach the keyboard to the last chunk only
+            if reply_markup and end >= len(text):
+                payload["reply_markup"] = reply_markup
+            response = TG_SESSION.post(
+                TELEGRAM_SEND_MESSAGE_URL,
+                data=orjson.dumps(payload),
+                timeout=5
+            )
+            response.raise_for_status()
     except Exception as e:
-        print(f"Failed to send message: {e}")
+        log.warning("Failed to send message: %s", e)
+
+# /add input validation
+VALID_COIN = re.compile(r"^[A-Z0-9]{1,12}$")
+# Plain decimals only; float() alone would also accept nan, inf and 1e999
+VALID_DECIMAL = re.compile(r"^(?:\d+(?:\.\d*)?|\.\d+)$")
+RESERVED_SHEET_NAMES = {"master", "dailyprices", "coinmappings"}
+
+def conflicting_sheet_title(sheet_name):
+    """Return an existing sheet title equal to sheet_name except for case, if any"""
+    lowered = sheet_name.lower()
+    return next(
+        (title for title in get_sheet_ids() if title.lower() == lowered and title != sheet_name),
+        None
+    )
 
-# Your existing functions (unchanged)
-def process_add_command(command):
+def process_add_command(parts):
     try:
-        parts = command.split(" ")
         if len(parts) != 7:
             return "Invalid format. Use: /add PERSON COIN PRICE QUANTITY EXCHANGE BUY/SELL"
 
-        person = parts[1].lower()
-        coin = parts[2].upper()
-        price = float(parts[3])
-        quantity = float(parts[4])
-        exchange = parts[5]
-        order_type = parts[6].upper()
+        _, person, coin, price, quantity, exchange, order_type = parts
+        person = person.lower()
+        coin = coin.upper()
+        order_type = order_type.upper()
 
-        if order_type not in ["BUY", "SELL"]:
+        # Validate everything before touching Sheets so bad input costs no quota
+        if not (VALID_DECIMAL.match(price) and VALID_DECIMAL.match(quantity)):
+            return "Invalid price/quantity. Use positive numbers."
+        price = float(price)
+        quantity = float(quantity)
+
+        if order_type not in ORDER_SIGNS:
             return "Invalid order type. Use BUY or SELL."
 
         if price <= 0 or quantity <= 0:
             return "Invalid price/quantity. Use positive numbers."
 
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if not VALID_COIN.match(coin):
+            return "Invalid coin symbol. Use letters and digits only (max 12)."
+
+        if coin.lower() in RESERVED_SHEET_NAMES:
+            return f"Invalid coin symbol '{coin}'. It is reserved for a system sheet."
+
+        if person in RESERVED_SHEET_NAMES:
+            return f"Invalid person name '{person}'. It is reserved for a system sheet."
+
+        # Sheet titles are unique regardless of case, so a person named like a
+        # coin (btc vs BTC) would land in, or collide with, that coin's tab
+        if person == coin.lower() or conflicting_sheet_title(person):
+            return f"Invalid person name '{person}'. It clashes with a coin sheet."
+        if conflicting_sheet_title(coin):
+            return f"Invalid coin symbol '{coin}'. It clashes with a person sheet."
+
+        timestamp = datetime.datetime.now().replace(microsecond=0)
         new_row = [timestamp, person, coin, price, quantity, exchange, price * quantity, order_type]
 
-        # Ensure the master sheet exists with headers
-        create_sheet_if_not_exists("Master")
-
-        # Ensure coin and person sheets exist with headers
-        create_sheet_if_not_exists(coin)
-        create_sheet_if_not_exists(person)
-
-        # Append to Master Sheet
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range="Master!A2",
-            valueInputOption="USER_ENTERED",
-            body={"values": [new_row]}
-        ).execute()
-
-        # Append to Coin Sheet
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{coin}!A2",
-            valueInputOption="USER_ENTERED",
-            body={"values": [new_row]}
-        ).execute()
-
-        # Append to Person Sheet
-        sheets_service.spreadsheets().values().append(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{person}!A2",
-            valueInputOption="USER_ENTERED",
-            body={"values": [new_row]}
-        ).execute()
-
-        return f"✅ Trade recorded: {person} {order_type.lower()} {quantity} {coin} at ${price} on {exchange}."
+        # Ensure the master, coin and person sheets exist with headers
+        sheet_ids = ensure_trade_sheets(["Master", coin, person])
+        if sheet_ids is None:
+            return "Error processing /add command: could not prepare target sheets"
+
+        # Append to Master, Coin and Person sheets via the batched writer
+        written_after = time.monotonic()
+        try:
+            append_row_to_sheets(sheet_ids, new_row)
+        except FutureTimeoutError:
+            # The row may still land later, so cached totals can't be trusted
+            invalidate_sheet_cache(coin, person)
+            return "⏳ The sheet write is taking too long. Check the sheet before re-sending this trade."
+
+        # Keep cached aggregates warm by applying the trade in memory
+        apply_trade_to_cache(
+            (coin, person), written_after,
+            coin, ORDER_SIGNS[order_type], quantity, price * quantity
+        )
+
+        # The mapping check may read CoinMappings and message the admin, so
+        # it runs in the background; the reply only notes what the cache knows
+        mappings = cached_coin_mappings()
+        EXECUTOR.submit(check_coin_mapping, coin)
+
+        reply = f"✅ Trade recorded: {person} {order_type.lower()} {quantity} {coin} at ${price} on {exchange}."
+        if mappings is not None and not mappings.get(coin):
+            reply += "\n⚠️ No CoinGecko mapping for this coin yet - admin notified."
+        return reply
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in process_add_command")
         return f"Error processing /add command: {e}"
 
-def process_average_command(command):
+def process_average_command(parts):
     try:
-        parts = command.split(" ")
         if len(parts) != 2:
             return "Invalid format. Use: /average COIN"
 
-        coin = parts[1].upper()
-        return calculate_average(coin)
+        _, coin = parts
+        return calculate_average(coin.upper())
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in process_average_command")
         return f"Error processing /average command: {e}"
 
-def process_holdings_command(command):
+def process_holdings_command(parts):
     try:
-        parts = command.split(" ")
-
         if len(parts) == 2:
-            coin = parts[1].upper()
-            return calculate_total_holdings_for_coin(coin)
+            _, coin = parts
+            return calculate_total_holdings_for_coin(coin.upper())
         elif len(parts) == 3:
-            person = parts[1].lower()
-            coin = parts[2].upper()
-            return calculate_total_holdings_for_person_and_coin(person, coin)
+            _, person, coin = parts
+            return calculate_total_holdings_for_person_and_coin(person.lower(), coin.upper())
         else:
             return "Invalid format. Use /holdings COIN or /holdings PERSON COIN"
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in process_holdings_command")
         return f"Error processing /holdings command: {e}"
 
-def create_sheet_if_not_exists(sheet_name):
+HELP_TEXT = """📚 Available Commands:
+/add - Record new trade
+/average - Check average price
+/holdings - View holdings
+
+📱 Use buttons or type commands directly!"""
+UNKNOWN_COMMAND_TEXT = "❌ Unknown command. Use buttons or type /help"
+
+# Command dispatch table; handlers receive the whitespace-split message
+COMMAND_HANDLERS = {
+    "/help": lambda parts: HELP_TEXT,
+    "/add": process_add_command,
+    "/average": process_average_command,
+    "/holdings": process_holdings_command,
+}
+
+# Sheet title -> sheetId map, kept current as sheets are added and re-read
+# every SHEET_IDS_TTL seconds so edits made in the Sheets UI reconcile. It is
+# replaced rather than mutated so readers can iterate it safely.
+SHEET_IDS_TTL = 300  # seconds
+_sheet_ids = None
+_sheet_ids_expiry = 0.0
+_sheet_ids_lock = threading.RLock()
+
+def get_sheet_ids():
+    """Return {title: sheetId} for all sheets, reading metadata only when stale"""
+    global _sheet_ids, _sheet_ids_expiry
+    if _sheet_ids is None or time.monotonic() >= _sheet_ids_expiry:
+        with _sheet_ids_lock:
+            if _sheet_ids is None or time.monotonic() >= _sheet_ids_expiry:
+                spreadsheet = sheets_request(
+                    "GET", "", params={"fields": "sheets.properties(sheetId,title)"}
+                )
+                _sheet_ids = {
+                    sheet["properties"]["title"]: sheet["properties"]["sheetId"]
+                    for sheet in spreadsheet.get("sheets", [])
+                }
+                _sheet_ids_expiry = time.monotonic() + SHEET_IDS_TTL
+    return _sheet_ids
+
+def remember_sheet_ids(new_sheet_ids):
+    """Record newly created sheets without re-reading spreadsheet metadata"""
+    global _sheet_ids
+    with _sheet_ids_lock:
+        _sheet_ids = {**get_sheet_ids(), **new_sheet_ids}
+
+def forget_sheet_ids():
+    """Drop the sheet map so the next lookup re-reads spreadsheet metadata"""
+    global _sheet_ids
+    with _sheet_ids_lock:
+        _sheet_ids = None
+
+def is_already_exists_error(error):
+    """Return True if a Sheets HTTPError says a sheet name or id is taken"""
+    response = error.response
+    return response is not None and response.status_code == 400 and "already exists" in response.text
+
+# Preflight: one metadata read at startup both proves the credentials can open
+# the spreadsheet and loads the sheet map, so a bad key fails the boot instead
+# of the first webhook or price tick
+try:
+    get_sheet_ids()
+except Exception as e:
+    raise ValueError(f"Failed to open spreadsheet {SPREADSHEET_ID}: {e}")
+
+_sheet_create_lock = threading.Lock()
+TRADE_HEADERS = ["Timestamp", "Person", "Coin", "Price", "Quantity", "Exchange", "Total", "Type"]
+
+def ensure_trade_sheets(sheet_names, headers=TRADE_HEADERS):
+    """Ensure trade sheets exist and return their sheetIds, or None on failure"""
     try:
-        spreadsheet = sheets_service.spreadsheets().get(spreadsheetId=SPREADSHEET_ID).execute()
-        sheet_titles = [sheet["properties"]["title"] for sheet in spreadsheet.get("sheets", [])]
-
-        if sheet_name not in sheet_titles:
-            # Create the new sheet
-            requests_body = {
-                "requests": [
-                    {
-                        "addSheet": {
-                            "properties": {
-                                "title": sheet_name
-                            }
-                        }
+        sheet_ids = get_sheet_ids()
+        if all(name in sheet_ids for name in sheet_names):
+            return [sheet_ids[name] for name in sheet_names]
+
+        with _sheet_create_lock:
+            return add_trade_sheets(sheet_names, headers)
+    except Exception as e:
+        log.exception("Error in ensure_trade_sheets")
+        return None
+
+def add_trade_sheets(sheet_names, headers=TRADE_HEADERS, retry_stale=True):
+    """Add any missing sheets with a header row in a single batchUpdate"""
+    sheet_ids = get_sheet_ids()
+    missing = [name for name in dict.fromkeys(sheet_names) if name not in sheet_ids]
+    if not missing:
+        return [sheet_ids[name] for name in sheet_names]
+
+    # Create the new sheets and write their headers in one request; picking
+    # the sheetIds ourselves lets the header writes target them directly
+    first_id = max(sheet_ids.values(), default=0) + 1
+    new_sheet_ids = {name: first_id + offset for offset, name in enumerate(missing)}
+    header_row = to_cell_data(headers)
+    requests_body = {"requests": []}
+    for name, sheet_id in new_sheet_ids.items():
+        requests_body["requests"].extend([
+            {
+                "addSheet": {
+                    "properties": {
+                        "sheetId": sheet_id,
+                        "title": name
                     }
-                ]
+                }
+            },
+            {
+                "updateCells": {
+                    "start": {"sheetId": sheet_id, "rowIndex": 0, "columnIndex": 0},
+                    "rows": [header_row],
+                    "fields": "userEnteredValue"
+                }
             }
-            sheets_service.spreadsheets().batchUpdate(
-                spreadsheetId=SPREADSHEET_ID, body=requests_body
-            ).execute()
-            
-            # Add headers to the new sheet
-            headers = ["Timestamp", "Person", "Coin", "Price", "Quantity", "Exchange", "Total", "Type"]
-            sheets_service.spreadsheets().values().update(
-                spreadsheetId=SPREADSHEET_ID,
-                range=f"{sheet_name}!A1",
-                valueInputOption="RAW",
-                body={"values": [headers]}
-            ).execute()
+        ])
+    try:
+        sheets_request("POST", ":batchUpdate", body=requests_body)
+    except requests.HTTPError as e:
+        # The map can be up to SHEET_IDS_TTL old, so a sheet added from the
+        # Sheets UI since then makes addSheet collide; refresh and retry once
+        if not (retry_stale and is_already_exists_error(e)):
+            raise
+        log.info("Sheet map is stale, reloading metadata: %s", e)
+        forget_sheet_ids()
+        return add_trade_sheets(sheet_names, headers, retry_stale=False)
+
+    remember_sheet_ids(new_sheet_ids)
+    return [new_sheet_ids.get(name, sheet_ids.get(name)) for name in sheet_names]
+
+# Sheets stores date-times as fractional days since this epoch; writing
+# timestamps as serials keeps column A a real date, as USER_ENTERED did
+SHEETS_EPOCH = datetime.datetime(1899, 12, 30)
+TIMESTAMP_FORMAT = {"numberFormat": {"type": "DATE_TIME", "pattern": "yyyy-mm-dd hh:mm:ss"}}
+
+def to_cell_data(row):
+    """Convert a list of Python values into Sheets CellData for appendCells"""
+    cells = []
+    for value in row:
+        if isinstance(value, datetime.datetime):
+            cells.append({
+                "userEnteredValue": {"numberValue": (value - SHEETS_EPOCH) / datetime.timedelta(days=1)},
+                "userEnteredFormat": TIMESTAMP_FORMAT
+            })
+        elif isinstance(value, (int, float)):
+            cells.append({"userEnteredValue": {"numberValue": value}})
+        else:
+            cells.append({"userEnteredValue": {"stringValue": str(value)}})
+    return {"values": cells}
+
+def append_cells_requests(sheet_ids, row):
+    """Build appendCells requests that add the same row to several sheets"""
+    row_data = to_cell_data(row)
+    return [
+        {
+            "appendCells": {
+                "sheetId": sheet_id,
+                "rows": [row_data],
+                "fields": "userEnteredValue,userEnteredFormat.numberFormat"
+            }
+        }
+        for sheet_id in sheet_ids
+    ]
+
+# Trade rows are written by a background writer: it flushes as soon as it is
+# free, and rows queued while a flush is in flight (up to WRITE_BATCH_MAX)
+# share the next batchUpdate call, so bursts of /add commands coalesce
+# without delaying a lone trade.
+WRITE_BATCH_MAX = 25
+WRITE_TIMEOUT = 60  # seconds an /add waits for its row to be written
+_pending_writes = queue.Queue()
+
+def append_row_to_sheets(sheet_ids, row):
+    """Queue a row for the batched writer and wait until it has been flushed"""
+    future = Future()
+    _pending_writes.put((sheet_ids, row, future))
+    return future.result(timeout=WRITE_TIMEOUT)
+
+def is_client_error(error):
+    """Return True if a Sheets HTTPError is a 4xx other than rate limiting"""
+    response = error.response
+    return response is not None and 400 <= response.status_code < 500 and response.status_code != 429
+
+def flush_pending_writes(batch):
+    """Write a batch of queued rows in one batchUpdate and resolve their futures"""
+    body = {
+        "requests": [
+            request_body
+            for sheet_ids, row, _ in batch
+            for request_body in append_cells_requests(sheet_ids, row)
+        ]
+    }
+    try:
+        sheets_request("POST", ":batchUpdate", body=body)
+    except requests.HTTPError as e:
+        if is_client_error(e):
+            # batchUpdate is all-or-nothing, so one bad row must not fail the
+            # other users' trades; retry each of them on its own
+            if len(batch) > 1:
+                for entry in batch:
+                    flush_pending_writes([entry])
+                return
+            # Usually a tab deleted in the UI while its sheetId was still mapped
+            forget_sheet_ids()
+        for _, _, future in batch:
+            future.set_exception(e)
     except Exception as e:
-        traceback.print_exc()
+        for _, _, future in batch:
+            future.set_exception(e)
+    else:
+        for _, _, future in batch:
+            future.set_result(None)
+
+def run_write_batcher():
+    """Flush queued rows as they arrive until the process exits"""
+    while True:
+        batch = [_pending_writes.get()]
+        while len(batch) < WRITE_BATCH_MAX:
+            try:
+                batch.append(_pending_writes.get_nowait())
+            except queue.Empty:
+                break
+        flush_pending_writes(batch)
+
+threading.Thread(target=run_write_batcher, name="sheet-writer", daemon=True).start()
 
 def sheet_exists(sheet_name):
     """Check if a sheet with given name exists"""
     try:
-        spreadsheet = sheets_service.spreadsheets().get(
-            spreadsheetId=SPREADSHEET_ID
-        ).execute()
-        return any(sheet["properties"]["title"].lower() == sheet_name.lower() 
-                 for sheet in spreadsheet.get("sheets", []))
+        return any(title.lower() == sheet_name.lower() for title in get_sheet_ids())
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in sheet_exists")
         return False
 
 def calculate_average(coin):
@@ -453,66 +994,34 @@ def calculate_average(coin):
             
         return f"Average buy price for {coin}: ${avg_price:.2f}"
     except Exception as e:
-        traceback.print_exc()
+        log.exception("Error in calculate_average")
         return f"Error calculating average: {e}"
 
+def average_from_totals(buy_quantity, buy_cost):
+    """Return (average buy price, error) from summed BUY quantity and cost"""
+    if buy_quantity == 0:
+        return None, "No BUY transactions found"
+    return buy_cost / buy_quantity, None
+
 def get_average_buy_price(coin, person=None):
     """Calculate average buy price for a coin (optionally filtered by person)"""
     try:
+        # Buy totals are memoized with the cached sheet snapshot
         if person:
             if not sheet_exists(person):
                 return None, f"Person '{person}' not found"
-            sheet_name = person
-            range_name = f"{sheet_name}!A2:H"
-            filter_coin = True
+            _, total_quantity, total_cost = get_trade_totals(person, coin)
         else:
             if not sheet_exists(coin):
                 return None, f"Coin '{coin}' not found"
-            sheet_name = coin
-            range_name = f"{sheet_name}!A2:H"
-            filter_coin = False
-
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=range_name,
-            valueRenderOption="UNFORMATTED_VALUE"
-        ).execute()
-        values = result.get('values', [])
-
-        total_cost = 0.0
-        total_quantity = 0.0
-        filtered_rows = []
-
-        if person:
-            filtered_rows = [
-                row for row in values
-                if len(row) >= 8 
-                and row[2].upper() == coin 
-                and row[7].upper() == "BUY"
-            ]
-        else:
-            filtered_rows = [
-                row for row in values
-                if len(row) >= 8 
-                and row[7].upper() == "BUY"
-            ]
-
-        for row in filtered_rows:
-            try:
-                total = float(row[6])
-                quantity = float(row[4])
-                total_cost += total
-                total_quantity += quantity
-            except (ValueError, IndexError):
-                continue
-
-        if total_quantity == 0:
-            return None, "No BUY transactions found"
+            sheet_totals = get_sheet_totals(coin).values()
+            total_quantity = sum(coin_totals[1] for coin_totals in sheet_totals)
+            total_cost = sum(coin_totals[2] for coin_totals in sheet_totals)
 
-        return total_cost / total_quantity, None
+        return average_from_totals(total_quantity, total_cost)
 
-    except HttpError as e:
-        if e.resp.status == 404:
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
             return None, "Sheet not found"
         return None, f"API Error: {e}"
     except Exception as e:
@@ -523,25 +1032,14 @@ def calculate_total_holdings_for_coin(coin):
         if not sheet_exists(coin):
             return f"Coin '{coin}' not found"
 
-        sheet_name = coin
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{sheet_name}!A2:H",
-            valueRenderOption="UNFORMATTED_VALUE"
-        ).execute()
-        values = result.get('values', [])
-
-        total_quantity = 0.0
-        for row in values:
-            if len(row) >= 8:
-                order_type = row[7].upper()
-                try:
-                    quantity = float(row[4])
-                    total_quantity += quantity if order_type == "BUY" else -quantity
-                except (ValueError, IndexError):
-                    continue
-
-        avg_price, avg_error = get_average_buy_price(coin)
+        # A coin sheet only holds that coin's trades, so fold every entry;
+        # quantity and average come from the same snapshot
+        sheet_totals = get_sheet_totals(coin).values()
+        total_quantity = sum(coin_totals[0] for coin_totals in sheet_totals)
+        avg_price, avg_error = average_from_totals(
+            sum(coin_totals[1] for coin_totals in sheet_totals),
+            sum(coin_totals[2] for coin_totals in sheet_totals)
+        )
         usd_value = total_quantity * avg_price if avg_price else None
 
         response = f"Total holdings for {coin}: {total_quantity:.8f}"
@@ -552,7 +1050,7 @@ def calculate_total_holdings_for_coin(coin):
         
         return response
 
-    except HttpError as e:
+    except requests.HTTPError as e:
         return f"Error accessing sheet: {e}"
     except Exception as e:
         return f"Error calculating holdings: {e}"
@@ -562,25 +1060,8 @@ def calculate_total_holdings_for_person_and_coin(person, coin):
         if not sheet_exists(person):
             return f"Person '{person}' not found"
 
-        sheet_name = person
-        result = sheets_service.spreadsheets().values().get(
-            spreadsheetId=SPREADSHEET_ID,
-            range=f"{sheet_name}!A2:H",
-            valueRenderOption="UNFORMATTED_VALUE"
-        ).execute()
-        values = result.get('values', [])
-
-        total_quantity = 0.0
-        for row in values:
-            if len(row) >= 8 and row[2].upper() == coin:
-                order_type = row[7].upper()
-                try:
-                    quantity = float(row[4])
-                    total_quantity += quantity if order_type == "BUY" else -quantity
-                except (ValueError, IndexError):
-                    continue
-
-        avg_price, avg_error = get_average_buy_price(coin, person=person)
+        total_quantity, buy_quantity, buy_cost = get_trade_totals(person, coin)
+        avg_price, avg_error = average_from_totals(buy_quantity, buy_cost)
         usd_value = total_quantity * avg_price if avg_price else None
 
         response = f"Total holdings for {person} in {coin}: {total_quantity:.8f}"
@@ -591,12 +1072,39 @@ def calculate_total_holdings_for_person_and_coin(person, coin):
         
         return response
 
-    except HttpError as e:
+    except requests.HTTPError as e:
         return f"Error accessing sheet: {e}"
     except Exception as e:
         return f"Error calculating holdings: {e}"
 
+# ---------------------------
+# Background Jobs
+# ---------------------------
+# Scheduled last so jobs that start right away only call helpers that are
+# already defined, and the startup preflight has loaded the sheet map
+
+# Schedule price updates every 5 minutes
+scheduler.add_job(
+    record_prices,
+    'interval',
+    minutes=5,
+    next_run_time=datetime.datetime.now() + datetime.timedelta(seconds=10)
+)
+
+def prime_caches():
+    """Warm the CoinMappings cache so the first /add after boot finds it loaded"""
+    try:
+        get_coin_mappings()
+    except Exception as e:
+        log.exception("Cache priming failed")
+
+# The sheet map is loaded by the startup preflight; mappings load on a
+# scheduler thread so booting the web server never waits on them
+scheduler.add_job(prime_caches, 'date', run_date=datetime.datetime.now())
+
 if __name__ == "__main__":
+    # Local development only; production runs `gunicorn main:app` with the
+    # threaded worker settings in gunicorn.conf.py. The scheduler is already
+    # started at import time.
     port = int(os.environ.get("PORT", 5000))
-    scheduler.start()
-    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
+    app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False, threaded=True)